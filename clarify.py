@@ -1,25 +1,60 @@
+import PIL
 from PIL import Image
 import os
 import math
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
 from gradio_client import Client, handle_file
 import time
+import atexit
+import queue
 import logging
-import re
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import pyvips  # Optional: streams the collated image to disk instead of building it in memory
+except (ImportError, OSError):
+    pyvips = None
+
+# Set up logging: records are only queued by the caller and written to the file and console
+# by a background listener thread, keeping formatting and I/O out of the tile loops
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_log_handlers = [
+    logging.FileHandler('split_and_enhance.log'),
+    logging.StreamHandler()
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+_log_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))  # Final formatting is done by the listener's handlers
+_log_listener = QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Flush queued records on exit
 
-# Set up logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('split_and_enhance.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[_queue_handler]
 )
 logger = logging.getLogger(__name__)
 
-def resize_to_nearest_1024(image):
-    """Resize image so width and height are the smallest multiples of 1024 >= original size, maintaining aspect ratio."""
-    original_width, original_height = image.size
+# Source images are routinely several hundred megapixels; disable Pillow's decompression bomb
+# check so they open without an error
+Image.MAX_IMAGE_PIXELS = None
+
+# Collation canvas kept from the previous run when collate_tiles is called with reuse_canvas=True,
+# keyed by (width, height), so batches of same-sized images reuse it instead of allocating a fresh one
+_canvas_pool = {}
+
+# Grids up to this many tiles are saved with threads in-process; spawning worker processes
+# and copying the resized image into shared memory only pays off for larger grids
+THREADED_SPLIT_MAX_TILES = 4
+
+@functools.lru_cache(maxsize=None)
+def _target_size(original_width, original_height):
+    """Return the (width, height) resize_to_nearest_1024 targets for a given source size."""
     aspect_ratio = original_width / original_height
 
     # Calculate the smallest multiple of 1024 >= original width
@@ -35,22 +70,86 @@ def resize_to_nearest_1024(image):
         # Recalculate width based on height to better match original aspect ratio
         new_width = math.ceil((new_height * aspect_ratio) / 1024) * 1024
 
+    return new_width, new_height
+
+def resize_to_nearest_1024(image):
+    """Resize image so width and height are the smallest multiples of 1024 >= original size, maintaining aspect ratio."""
+    original_width, original_height = image.size
+    if original_width % 1024 == 0 and original_height % 1024 == 0:
+        # Already aligned to the tile grid, skip the full-image LANCZOS pass
+        logger.info(f"Image size {image.size} is already a multiple of 1024, no resize needed")
+        return image
+
+    new_width, new_height = _target_size(original_width, original_height)
     logger.info(f"Resizing from {image.size} to ({new_width}, {new_height})")
     return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
 
+def _performance_cores():
+    """Return the set of performance-core CPU ids on hybrid Intel CPUs under Linux, or None if not available."""
+    try:
+        with open('/sys/devices/cpu_core/cpus', encoding='utf-8') as f:
+            cpu_list = f.read().strip()
+    except OSError:
+        return None
+
+    cpus = set()
+    for part in cpu_list.split(','):
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def _resize_on_performance_cores(image):
+    """Run resize_to_nearest_1024 pinned to the performance cores, so the single-threaded LANCZOS pass isn't scheduled on an efficiency core."""
+    if not hasattr(os, 'sched_setaffinity'):
+        return resize_to_nearest_1024(image)
+
+    previous_affinity = os.sched_getaffinity(0)
+    performance_cores = (_performance_cores() or set()) & previous_affinity
+    if not performance_cores or performance_cores == previous_affinity:
+        return resize_to_nearest_1024(image)
+
+    os.sched_setaffinity(0, performance_cores)
+    try:
+        return resize_to_nearest_1024(image)
+    finally:
+        os.sched_setaffinity(0, previous_affinity)
+
+@functools.lru_cache(maxsize=1)
+def _attach_shared_memory(name):
+    """Attach to the shared resized image once per worker process."""
+    return shared_memory.SharedMemory(name=name)
+
+def _save_jpeg(tile, output_path):
+    """Encode and write a tile as JPEG; libjpeg releases the GIL, so this can run in a worker thread."""
+    tile.save(output_path, "JPEG", quality=95)
+    return output_path
+
+def _save_tile(args):
+    """Read a single 1024x1024 tile from the shared resized image and save it as JPEG (runs in a worker process)."""
+    shm_name, shape, left, top, output_path = args
+    mode = "RGB" if len(shape) == 3 else "L"
+    channels = 3 if mode == "RGB" else 1
+    row_stride = shape[1] * channels
+
+    # Decode the tile straight from the shared buffer using the row stride, so the only copy is
+    # the one into the PIL image
+    offset = top * row_stride + left * channels
+    region = _attach_shared_memory(shm_name).buf[offset:offset + 1023 * row_stride + 1024 * channels]
+    tile = Image.frombytes(mode, (1024, 1024), region, "raw", mode, row_stride, 1)
+    return _save_jpeg(tile, output_path)
+
 def split_image(image_path, output_dir):
-    """Split image into 1024x1024 tiles and return list of tile paths."""
+    """Split image into 1024x1024 tiles and return the tile paths (row-major order), rows and cols."""
     try:
         img = Image.open(image_path)
     except Exception as e:
         logger.error(f"Error opening image: {e}")
-        return []
+        return [], 0, 0
 
     base_name = os.path.splitext(os.path.basename(image_path))[0]
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
 
-    resized_img = resize_to_nearest_1024(img)
+    resized_img = _resize_on_performance_cores(img)
     width, height = resized_img.size
     rows = height // 1024
     cols = width // 1024
@@ -58,27 +157,66 @@ def split_image(image_path, output_dir):
     logger.info(f"Original size: {img.size}")
     logger.info(f"Resized to: {resized_img.size}")
     logger.info(f"Splitting into {rows} rows and {cols} columns")
+    del img  # The decoded source is no longer needed once resized
 
-    tile_paths = []
+    # JPEG tiles, and the array round trip through shared memory, need a plain RGB or L image
+    if resized_img.mode not in ("RGB", "L"):
+        resized_img = resized_img.convert("RGB")
+
+    # Join the output path once; braces in the folder or file name are escaped for str.format
+    output_template = os.path.join(output_dir, base_name).replace("{", "{{").replace("}", "}}") + "R{row}C{col}.jpg"
+    tiles = []
     for row in range(rows):
         for col in range(cols):
             left = col * 1024
             top = row * 1024
-            right = left + 1024
-            bottom = top + 1024
-
-            tile = resized_img.crop((left, top, right, bottom))
-            output_filename = f"{base_name}R{row + 1}C{col + 1}.jpg"
-            output_path = os.path.join(output_dir, output_filename)
-
-            tile.save(output_path, "JPEG", quality=95)
-            tile_paths.append(output_path)
-            logger.info(f"Saved {output_filename}")
+            output_path = output_template.format(row=row + 1, col=col + 1)
+            tiles.append((left, top, output_path))
+
+    if len(tiles) <= THREADED_SPLIT_MAX_TILES:
+        # Crop on this thread while the pool encodes and writes the previous tiles
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(_save_jpeg, resized_img.crop((left, top, left + 1024, top + 1024)), output_path)
+                for left, top, output_path in tiles
+            ]
+            wait(futures)
+        tile_paths = [future.result() for future in futures]
+        for output_path in tile_paths:
+            logger.debug(f"Saved {os.path.basename(output_path)}")
+        logger.info(f"Saved {len(tile_paths)} tiles to {output_dir}")
+        return tile_paths, rows, cols
+
+    # Place the decoded pixels in shared memory once so worker processes slice their tile from it
+    # directly; each worker only receives the segment name and tile coordinates
+    shape = (height, width, 3) if resized_img.mode == "RGB" else (height, width)
+    size = math.prod(shape)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        shm.buf[:size] = resized_img.tobytes()
+        # Only the shared copy is needed from here on; drop the local one before the tile loop
+        del resized_img
+        jobs = [(shm.name, shape, left, top, output_path) for left, top, output_path in tiles]
+
+        # JPEG encoding is CPU-bound and independent per tile, so spread it across cores
+        tile_paths = []
+        with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+            for output_path in executor.map(_save_tile, jobs):
+                tile_paths.append(output_path)
+                logger.debug(f"Saved {os.path.basename(output_path)}")
+    finally:
+        shm.close()
+        shm.unlink()
+    logger.info(f"Saved {len(tile_paths)} tiles to {output_dir}")
 
     return tile_paths, rows, cols  # Return rows and cols for later use
 
-def process_tiles(tile_paths, stylization="HQ", output_status_file="processing_status.txt"):
-    """Process image tiles using the batch processing API with progress tracking."""
+def process_tiles(tile_paths, stylization="HQ", output_status_file="processing_status.txt", batch_size=4, max_inflight=2):
+    """Process image tiles using the batch processing API with progress tracking.
+
+    Tiles are sent in batches of batch_size, keeping up to max_inflight batches queued on the
+    server so uploading and downloading one batch overlaps with inference of another.
+    """
     try:
         client = Client("http://127.0.0.1:7860/")
         logger.info("Connected to API server")
@@ -90,11 +228,12 @@ def process_tiles(tile_paths, stylization="HQ", output_status_file="processing_s
         logger.warning("No tiles to process")
         return []
 
+    # gradio_client uploads files by path (handle_file takes a path or URL, not a file object),
+    # so tiles go through the work folder; they were just written and are read back from the page cache
     file_list = [handle_file(f) for f in tile_paths]
     total_tiles = len(file_list)
 
     processing_params = {
-        "files": file_list,
         "prompt": stylization + ", masterpiece, best quality, highres, detailed, 4k",
         "negative_prompt": "worst quality, low quality, blurry, artifacts",
         "seed": -1,
@@ -110,12 +249,38 @@ def process_tiles(tile_paths, stylization="HQ", output_status_file="processing_s
         "solver": "DPMSolver"
     }
 
+    inflight = deque()
     try:
-        logger.info("Starting batch processing...")
-        job = client.submit(**processing_params, api_name="/batch_process_images")
-
+        batches = [file_list[i:i + batch_size] for i in range(0, total_tiles, batch_size)]
+        logger.info(f"Starting batch processing of {total_tiles} tiles in {len(batches)} batches...")
+
+        next_batch = 0
+        batch_statuses = []
+        recent_enhancements = []
+        before_after = None
+        tiles_done = 0
         last_progress = -1
-        while not job.done():
+        poll_interval = 0.05
+        while inflight or next_batch < len(batches):
+            while next_batch < len(batches) and len(inflight) < max_inflight:
+                batch = batches[next_batch]
+                job = client.submit(files=batch, **processing_params, api_name="/batch_process_images")
+                inflight.append((job, len(batch)))
+                next_batch += 1
+
+            # Results are collected in submission order so enhanced paths stay aligned with the tiles
+            job, batch_tiles = inflight[0]
+            if job.done():
+                inflight.popleft()
+                batch_status, batch_enhancements, batch_before_after = job.result()
+                batch_statuses.append(batch_status)
+                recent_enhancements.extend(batch_enhancements)
+                if batch_before_after:
+                    before_after = batch_before_after
+                tiles_done += batch_tiles
+                poll_interval = 0.05
+                continue
+
             status = job.status()
             if hasattr(status, 'progress_data') and status.progress_data:
                 progress_unit = status.progress_data[0]
@@ -128,14 +293,19 @@ def process_tiles(tile_paths, stylization="HQ", output_status_file="processing_s
                 else:
                     logger.warning(f"Unknown progress_data structure: {progress_unit}")
                     progress = 0
-                if isinstance(progress, (int, float)) and progress != last_progress:
-                    percentage = min(100, max(0, int(progress * 100)))
-                    logger.info(f"Processing progress: {percentage}%")
-                    last_progress = progress
-            time.sleep(1)  # Wait 1 second before checking again
-
-        result = job.result()
-        status, recent_enhancements, before_after = result
+                if isinstance(progress, (int, float)):
+                    # Scale the current batch's progress to the whole set of tiles
+                    progress = (tiles_done + progress * batch_tiles) / total_tiles
+                    if progress != last_progress:
+                        percentage = min(100, max(0, int(progress * 100)))
+                        logger.info(f"Processing progress: {percentage}%")
+                        last_progress = progress
+                        poll_interval = 0.05
+            # Back off while nothing changes, but check again quickly after progress moves
+            time.sleep(poll_interval)
+            poll_interval = min(1.0, poll_interval * 2)
+
+        status = "; ".join(str(batch_status) for batch_status in batch_statuses)
 
         with open(output_status_file, 'w', encoding='utf-8') as f:
             f.write(f"Processing Status: {status}\n\n")
@@ -158,16 +328,56 @@ def process_tiles(tile_paths, stylization="HQ", output_status_file="processing_s
 
     except Exception as e:
         logger.error(f"Error during processing: {e}")
+        # Stop batches still queued or running on the server; their results would be discarded
+        for job, _ in inflight:
+            try:
+                job.cancel()
+            except Exception as cancel_error:
+                logger.warning(f"Failed to cancel pending batch: {cancel_error}")
         with open(output_status_file, 'w', encoding='utf-8') as f:
             f.write(f"Error: {str(e)}\n")
         return []
 
-def collate_tiles(enhanced_paths, rows, cols, output_dir, base_name):
-    """Collate enhanced tiles into a single image."""
+def _collate_with_vips(enhanced_paths, cols, tile_size, final_output_path):
+    """Join the tiles with libvips, which streams the output in strips instead of allocating the full image."""
+    tiles = []
+    for tile_path in enhanced_paths:
+        tile = pyvips.Image.new_from_file(tile_path, access='sequential')
+        if tile.width != tile_size or tile.height != tile_size:
+            tile = tile.resize(tile_size / tile.width, vscale=tile_size / tile.height, kernel='lanczos3')
+        tiles.append(tile)
+    pyvips.Image.arrayjoin(tiles, across=cols).write_to_file(final_output_path, Q=95, subsample_mode='off')
+
+def _load_tile(tile_path, tile_size, mode):
+    """Decode an enhanced tile, resized and converted to fit the canvas (runs in a worker thread)."""
+    try:
+        tile = Image.open(tile_path)
+        tile.load()
+        if tile.size[0] != tile_size or tile.size[1] != tile_size:
+            tile = tile.resize((tile_size, tile_size), Image.Resampling.LANCZOS)
+            logger.info(f"Resized {os.path.basename(tile_path)} to {tile_size}x{tile_size}")
+        if tile.mode != mode:
+            tile = tile.convert(mode)
+        return tile
+    except Exception as e:
+        logger.error(f"Error processing tile {tile_path}: {e}")
+        return None
+
+def collate_tiles(enhanced_paths, rows, cols, output_dir, base_name, reuse_canvas=False):
+    """Collate enhanced tiles into a single image.
+
+    enhanced_paths must be in the same row-major order as the tiles returned by split_image.
+    With reuse_canvas=True the canvas is kept after saving so the next call at the same size can
+    reuse it; leave it off for single runs, as the canvas can be several GB.
+    """
     if not enhanced_paths:
         logger.error("No enhanced tiles to collate")
         return
 
+    if len(enhanced_paths) != rows * cols:
+        logger.error(f"Expected {rows * cols} enhanced tiles but got {len(enhanced_paths)}, cannot place them on the grid")
+        return
+
     # Determine tile size from the first enhanced tile
     try:
         first_tile = Image.open(enhanced_paths[0])
@@ -178,51 +388,80 @@ def collate_tiles(enhanced_paths, rows, cols, output_dir, base_name):
         tile_size = 4096  # Fallback to default if unable to determine
         logger.warning(f"Using fallback tile size: {tile_size}x{tile_size}")
 
+    final_output_path = os.path.join(output_dir, f"{base_name}_enhanced_full.jpg")
+
+    if pyvips is not None:
+        try:
+            _collate_with_vips(enhanced_paths, cols, tile_size, final_output_path)
+            logger.info(f"Collated image saved to {final_output_path} (libvips)")
+            return
+        except Exception as e:
+            logger.error(f"Error collating with libvips, falling back to Pillow: {e}")
+
     # Calculate full image dimensions
     full_width = cols * tile_size
     full_height = rows * tile_size
 
-    # Create a new blank image to paste tiles into
-    final_image = Image.new('RGB', (full_width, full_height))
-
-    # Regex to extract row and column from filename
-    pattern = re.compile(r'R(\d+)C(\d+)')
-
-    for tile_path in enhanced_paths:
-        try:
-            # Extract row and column from the filename
-            match = pattern.search(os.path.basename(tile_path))
-            if not match:
-                logger.warning(f"Could not parse row/column from {tile_path}")
+    # Reuse the previous canvas if asked and it has the same size (cleared in C), otherwise create a
+    # new blank one; any other pooled canvas is released first so it doesn't add to this run's peak
+    final_image = _canvas_pool.pop((full_width, full_height), None) if reuse_canvas else None
+    _canvas_pool.clear()
+    if final_image is not None:
+        final_image.paste((0, 0, 0), (0, 0, full_width, full_height))
+    else:
+        final_image = Image.new('RGB', (full_width, full_height))
+
+    # Decode tiles in parallel (libjpeg releases the GIL); pastes stay on this thread. Only a window of
+    # 2x the worker count is submitted at a time, so decoded tiles can't pile up behind a slow one
+    load_tile = functools.partial(_load_tile, tile_size=tile_size, mode=final_image.mode)
+    max_workers = os.cpu_count() or 1
+    pasted = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        next_tile = 0
+        while pending or next_tile < len(enhanced_paths):
+            while next_tile < len(enhanced_paths) and len(pending) < 2 * max_workers:
+                pending.append(executor.submit(load_tile, enhanced_paths[next_tile]))
+                next_tile += 1
+
+            i = next_tile - len(pending)
+            tile_path = enhanced_paths[i]
+            tile = pending.popleft().result()
+            if tile is None:
                 continue
-            row = int(match.group(1)) - 1  # Convert to 0-based index
-            col = int(match.group(2)) - 1
-
-            # Open the enhanced tile
-            tile = Image.open(tile_path)
-            if tile.size[0] != tile_size or tile.size[1] != tile_size:
-                tile = tile.resize((tile_size, tile_size), Image.Resampling.LANCZOS)
-                logger.info(f"Resized {os.path.basename(tile_path)} to {tile_size}x{tile_size}")
 
             # Calculate position to paste the tile
+            row, col = divmod(i, cols)
             left = col * tile_size
             top = row * tile_size
 
-            # Paste the tile into the final image
-            final_image.paste(tile, (left, top))
-            logger.info(f"Pasted tile {os.path.basename(tile_path)} at ({left}, {top})")
+            # Paste the decoded tile straight into the canvas with the C-level paste
+            final_image.im.paste(tile.im, (left, top, left + tile_size, top + tile_size))
+            logger.debug(f"Pasted tile {os.path.basename(tile_path)} at ({left}, {top})")
+            pasted += 1
+            del tile  # Release the decoded tile before waiting on the next one
+    logger.info(f"Pasted {pasted} of {len(enhanced_paths)} tiles")
+
+    # Save the final collated image with full-resolution chroma. Progressive and optimized Huffman
+    # coding are left off: libjpeg would buffer the whole image's coefficients for them, which for
+    # gigapixel outputs costs more memory than the canvas itself
+    final_image.save(final_output_path, "JPEG", quality=95, subsampling=0)
+    logger.info(f"Collated image saved to {final_output_path}")
 
-        except Exception as e:
-            logger.error(f"Error processing tile {tile_path}: {e}")
+    # Keep only the most recent canvas to bound the memory held between runs
+    if reuse_canvas:
+        _canvas_pool[(full_width, full_height)] = final_image
 
-    # Save the final collated image
-    final_output_path = os.path.join(output_dir, f"{base_name}_enhanced_full.jpg")
-    final_image.save(final_output_path, "JPEG", quality=95)
-    logger.info(f"Collated image saved to {final_output_path}")
+def splitandenhance(source_image, folder, stylization, reuse_canvas=False):
+    """Split source image into tiles, enhance them, and collate into a full image.
 
-def splitandenhance(source_image, folder, stylization):
-    """Split source image into tiles, enhance them, and collate into a full image."""
+    Batch callers processing many same-sized images can pass reuse_canvas=True to keep the
+    collation canvas between calls.
+    """
     logger.info(f"Starting process for {source_image}")
+    # Pillow-SIMD releases are tagged as post-releases of the matching Pillow version
+    simd_build = ".post" in PIL.__version__
+    logger.info(f"Using Pillow {PIL.__version__}{' (SIMD build)' if simd_build else ''}")
 
     # Split the image into tiles and get grid dimensions
     tile_paths, rows, cols = split_image(source_image, folder)
@@ -237,12 +476,13 @@ def splitandenhance(source_image, folder, stylization):
     if enhanced_paths:
         # Collate the enhanced tiles into a full image
         base_name = os.path.splitext(os.path.basename(source_image))[0]
-        collate_tiles(enhanced_paths, rows, cols, folder, base_name)
+        collate_tiles(enhanced_paths, rows, cols, folder, base_name, reuse_canvas)
 
     logger.info("Process completed")
 
-# Example usage
-source = "C:\\original.jpg"
-folder = "C:\\workfolder"
-stylization = "mechanical, gears, clockworks, metal, copper, silver, gold"
-splitandenhance(source, folder, stylization)
+# Example usage (guarded so tile worker processes can import this module safely)
+if __name__ == "__main__":
+    source = "C:\\original.jpg"
+    folder = "C:\\workfolder"
+    stylization = "mechanical, gears, clockworks, metal, copper, silver, gold"
+    splitandenhance(source, folder, stylization)